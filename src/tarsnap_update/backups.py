@@ -18,13 +18,20 @@
 #
 # Copyright 2025, Will Shanks
 
+import calendar
 import datetime
+import json
 import logging
 import os
-import re
+import random
+import shutil
 import subprocess
+import tempfile
 import time
-from itertools import repeat
+from functools import lru_cache
+from operator import itemgetter
+from pathlib import Path
+from urllib.parse import quote
 
 from tarsnap_update.list_filters import space_by_span
 
@@ -34,73 +41,305 @@ __all__ = ["run_managed_backup"]
 AGING_PARAMS = ((0.5 / 24, 2), (1, 14), (7, 60), (30, 730), (365, -1))
 DATE_FORMAT = "%Y-%m-%d_%Hh%Mm%Ss"
 MAX_RETRY = 5
-RETRY_DELAY = 600
-TARSNAP_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+RETRY_BASE_DELAY = 30
+RETRY_MAX_DELAY = 600
+RETRY_JITTER = 0.5
+SECONDS_PER_DAY = 24 * 60 * 60
+TARSNAP_HOMEBREW_BIN = "/home/linuxbrew/.linuxbrew/bin/tarsnap"
+WAIT_STEP = 60
 
 logger = logging.getLogger(__name__)
 
 
-def get_backup_list(base):
-    """Get list from tarsnap and filter by base"""
+def retry_delay(attempt):
+    """Seconds to wait after failed attempt number attempt (counting from 0)
+
+    The delay doubles with each attempt up to RETRY_MAX_DELAY so that brief
+    network outages are retried quickly while long ones are not retried in
+    rapid succession. Random jitter spreads out retries from separate runs.
+    """
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt)
+    return delay * (1 + random.uniform(-RETRY_JITTER, RETRY_JITTER))
+
+
+def wait(delay):
+    """Wait until delay seconds of wall clock time have passed
+
+    time.sleep does not count time that the system spends suspended, so a long
+    delay is slept in steps of at most WAIT_STEP, checking the wall clock after
+    each one.
+    """
+    deadline = time.time() + delay
+    while (remaining := deadline - time.time()) > 0:
+        time.sleep(min(WAIT_STEP, remaining))
+
+
+@lru_cache(maxsize=1)
+def lookup_tarsnap_bin():
+    """Find the tarsnap executable on PATH or in the Homebrew prefix"""
+    tarsnap_bin = shutil.which("tarsnap")
+    if tarsnap_bin is not None:
+        return tarsnap_bin
+    # PATH is often minimal when run from a systemd unit
+    if Path(TARSNAP_HOMEBREW_BIN).exists():
+        return TARSNAP_HOMEBREW_BIN
+    raise RuntimeError("Could not find tarsnap executable")
+
+
+def run_tarsnap(cmd):
+    """Run a tarsnap command and return its exit code
+
+    tarsnap's output is not passed through. Its error output is collected and
+    logged once it exits.
+    """
+    result = subprocess.run(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        # File names in tarsnap's messages need not be valid in the locale's
+        # encoding
+        errors="backslashreplace",
+        check=False,
+    )
+    stderr = result.stderr.strip()
+    if result.returncode != 0:
+        logger.warning("tarsnap exited with code %d: %s", result.returncode, stderr)
+    elif stderr:
+        # tarsnap prefixes its messages with "tarsnap: " already
+        logger.info("%s", stderr)
+    return result.returncode
+
+
+def list_archives(base):
+    """Run tarsnap --list-archives once and parse the archives of base
+
+    Returns a list of (name, datetime) tuples. Raises CalledProcessError if
+    tarsnap fails.
+    """
+    # Match the literal prefix of the archive names so that neither regex
+    # characters in base nor other bases that start with base (e.g. "home" and
+    # "home2") match
+    prefix = archive_prefix(base)
+    cmd = [lookup_tarsnap_bin(), "-v", "--list-archives"]
+    # Filter the output as it is read rather than holding all of it in memory
+    # Archives of other bases may have names that are not valid in the
+    # locale's encoding
+    with subprocess.Popen(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        text=True,
+        errors="backslashreplace",
+    ) as proc:
+        matches = [
+            line.rstrip("\n").partition("\t")
+            for line in proc.stdout
+            if line.startswith(prefix)
+        ]
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+    # tarsnap prints times as "%Y-%m-%d %H:%M:%S", which fromisoformat parses
+    # much faster than strptime. The output is only parsed after checking the
+    # exit code in case tarsnap died partway through a line.
+    return [
+        (backup, datetime.datetime.fromisoformat(timestamp))
+        for backup, _, timestamp in matches
+    ]
+
+
+def list_cache_path(base):
+    """Path of the file in which the archive list of base is cached"""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "tarsnap_update" / f"{quote(base, safe='')}.json"
+
+
+def load_list_cache(base, cachedir):
+    """Load the archive list of base saved by save_list_cache
+
+    Returns (backups, times) as for get_backup_list, or None if there is no
+    cached list or tarsnap's cache directory cachedir has been modified since
+    it was saved.
+    """
+    # Any problem with the cache is treated as a miss so that the list is
+    # fetched again and the cache file rewritten
+    try:
+        with open(list_cache_path(base), encoding="utf-8") as cache_file:
+            cache = json.load(cache_file)
+        if cache["mtime"] != os.stat(cachedir).st_mtime_ns:
+            return None
+        backups = [archive[0] for archive in cache["archives"]]
+        times = [
+            datetime.datetime.fromisoformat(archive[1])
+            for archive in cache["archives"]
+        ]
+    except (OSError, ValueError, KeyError, TypeError, IndexError):
+        return None
+    if not all(isinstance(backup, str) for backup in backups):
+        return None
+    return (backups, times)
+
+
+def save_list_cache(base, cachedir, backups, times):
+    """Save the archive list of base for load_list_cache
+
+    The list is tagged with the current modification time of tarsnap's cache
+    directory cachedir, so it should only be saved right after this process
+    has brought it up to date.
+    """
+    path = list_cache_path(base)
+    try:
+        cache = {
+            "mtime": os.stat(cachedir).st_mtime_ns,
+            "archives": [
+                [backup, backup_time.isoformat(sep=" ")]
+                for backup, backup_time in zip(backups, times)
+            ],
+        }
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as cache_file:
+            json.dump(cache, cache_file)
+    except OSError as err:
+        logger.warning("Could not save archive list cache: %s", err)
+
+
+def get_backup_list(base, cachedir=None):
+    """Get list from tarsnap and filter by base
+
+    If cachedir (tarsnap's cache directory) is given, the list saved by the
+    previous run is used when tarsnap has not modified cachedir since then.
+    """
+    if cachedir is not None:
+        cached = load_list_cache(base, cachedir)
+        if cached is not None:
+            logger.info("Using cached archive list")
+            return cached
+
     # Get the backup list from the tarsnap server
-    cmd = ["tarsnap", "-v", "--list-archives"]
     for idx in range(MAX_RETRY + 1):
         try:
-            backups_raw = subprocess.check_output(cmd, universal_newlines=True)
+            archives = list_archives(base)
             break
         except subprocess.CalledProcessError as err:
             if err.returncode not in [1, -11] or idx == MAX_RETRY:
                 raise err
             logger.info("list-archives exit code: %d", err.returncode)
-            time.sleep(RETRY_DELAY)
+            time.sleep(retry_delay(idx))
 
-    backups_raw = backups_raw.splitlines()
-    backups_raw = [backup.split("\t") for backup in backups_raw]
-    backups_raw = [backup for backup in backups_raw if re.match(base, backup[0])]
-    backups_raw.sort(key=lambda backup: backup[1], reverse=True)
+    archives.sort(key=itemgetter(1), reverse=True)
 
-    backups = [backup[0] for backup in backups_raw]
-    times = [
-        datetime.datetime.strptime(backup[1], TARSNAP_DATE_FORMAT)
-        for backup in backups_raw
-    ]
+    backups = [archive[0] for archive in archives]
+    times = [archive[1] for archive in archives]
+
+    if cachedir is not None:
+        save_list_cache(base, cachedir, backups, times)
 
     return (backups, times)
 
 
-def remove_backups(base, aging_params):
-    """Remove directories in deletions from destination"""
-    aging_params_td = [
-        (datetime.timedelta(ap[0]), datetime.timedelta(ap[1])) for ap in aging_params
+def delete_archives(deletions):
+    """Delete the archives named in deletions and return whether it succeeded"""
+    # Pass the names in a file rather than as -f arguments so that large
+    # deletions do not run into the system's argument length limit
+    with tempfile.NamedTemporaryFile("w", prefix="tarsnap_update_") as names_file:
+        names_file.write("\n".join(deletions) + "\n")
+        names_file.flush()
+        cmd = [lookup_tarsnap_bin(), "-d", "--archive-names", names_file.name]
+        for attempt in range(MAX_RETRY):
+            retcode = run_tarsnap(cmd)
+            if retcode == 0 or attempt == MAX_RETRY - 1:
+                break
+            time.sleep(retry_delay(attempt))
+    return retcode == 0
+
+
+def remove_backups(base, aging_params, backups=None, times=None, cachedir=None):
+    """Remove directories in deletions from destination
+
+    backups and times are the archive list as returned by get_backup_list. If
+    they are not passed, the list is fetched from the tarsnap server. If
+    cachedir is given, the list of remaining archives is cached for the next
+    run (see get_backup_list).
+    """
+    # Work in seconds so that space_by_span operates on plain numbers
+    aging_params_sec = [
+        (spacing * SECONDS_PER_DAY, bound * SECONDS_PER_DAY)
+        for spacing, bound in aging_params
     ]
-    backups, times = get_backup_list(base)
-    keep_idx = space_by_span(times, aging_params_td, reverse=True)
-    deletions = [backups[idx] for idx in range(len(backups)) if idx not in keep_idx]
+    if backups is None or times is None:
+        backups, times = get_backup_list(base, cachedir)
+    times_sec = [calendar.timegm(backup_time.timetuple()) for backup_time in times]
+    keep_idx = set(space_by_span(times_sec, aging_params_sec, reverse=True))
+    deletions = [backup for idx, backup in enumerate(backups) if idx not in keep_idx]
     if len(deletions) == 0:
         logger.info("No expired backups at this time")
-        return
-    logger.info("Deleting expired backups: %s", ", ".join(deletions))
-    args = [arg for f_d in zip(repeat("-f"), deletions) for arg in f_d]
-    cmd = ["tarsnap", "-d"] + args
-    for _ in range(MAX_RETRY):
-        retcode = subprocess.call(cmd)
-        if retcode == 0:
-            break
-        time.sleep(RETRY_DELAY)
+    else:
+        # Names sort chronologically. tarsnap deletes consecutive archives
+        # faster since they share more cached chunk metadata.
+        deletions.sort()
+        logger.info("Deleting expired backups: %s", ", ".join(deletions))
+        if not delete_archives(deletions):
+            return
 
+    if cachedir is not None:
+        keep = sorted(keep_idx)
+        save_list_cache(
+            base, cachedir, [backups[idx] for idx in keep], [times[idx] for idx in keep]
+        )
 
-def run_single_backup(target, base):
-    """Run the tarsnap backup"""
-    date_str = datetime.datetime.now().strftime(DATE_FORMAT)
-    archive = f"{base}: {date_str}"
-    cmd = ["tarsnap", "-c", "-f", archive, target]
+
+def archive_prefix(base):
+    """Prefix shared by the names of all archives of base"""
+    return f"{base}: "
+
+
+def archive_name(base, created):
+    """Name for the archive of base created at datetime created"""
+    return archive_prefix(base) + created.strftime(DATE_FORMAT)
+
+
+def run_single_backup(target, base, created=None):
+    """Run the tarsnap backup
+
+    created is the time used to name the archive (default: now).
+    """
+    created = created if created is not None else datetime.datetime.now()
+    archive = archive_name(base, created)
+    cmd = [lookup_tarsnap_bin(), "-c", "-f", archive, target]
     logger.info("Running backup: %s", ' '.join(cmd))
-    exit_code = subprocess.call(cmd)
+    exit_code = run_tarsnap(cmd)
     return exit_code
 
 
-def run_managed_backup(target, delay=0, buff=0, aging_params=None, name=None):
-    """Run a backup and prune old backups with failure handling"""
+def check_cachedir(cachedir):
+    """Expand cachedir and return it, or None if it is not a directory
+
+    The archive list cache is only a speed-up, so an unusable cachedir disables
+    it rather than stopping the backup.
+    """
+    if cachedir is None:
+        return None
+    cachedir = os.path.expanduser(cachedir)
+    if not os.path.isdir(cachedir):
+        logger.warning(
+            "tarsnap cache directory %s not found. Not caching archive list",
+            cachedir,
+        )
+        return None
+    return cachedir
+
+
+def run_managed_backup(  # pylint: disable=too-many-arguments
+    target, delay=0, buff=0, aging_params=None, name=None, *, cachedir=None
+):
+    """Run a backup and prune old backups with failure handling
+
+    If cachedir (tarsnap's cache directory) is given, the archive list is
+    cached between runs so that it is only fetched from the tarsnap server
+    when something other than this script has modified cachedir.
+    """
     aging_params = aging_params if aging_params is not None else AGING_PARAMS
     if any(len(p) != 2 for p in aging_params):
         raise ValueError(
@@ -111,37 +350,53 @@ def run_managed_backup(target, delay=0, buff=0, aging_params=None, name=None):
     else:
         base = os.path.basename(target)
     logger.info("Backup started for target %s with base %s", target, base)
+    cachedir = check_cachedir(cachedir)
 
+    backups = backup_times = None
     buff = buff - delay / 60
     if buff > 0:
-        _, backup_times = get_backup_list(base)
+        backups, backup_times = get_backup_list(base, cachedir)
         last_backup_time = backup_times[0]
-        if datetime.datetime.now() - last_backup_time < datetime.timedelta(
-            0, buff * 60
-        ):
+        # tarsnap lists archive times in local time, which timestamp() assumes
+        # for naive datetimes
+        if time.time() - last_backup_time.timestamp() < buff * 60:
             logger.info(
                 (
                     "Last backup at %s occurred within buffer of %d "
                     "minutes. Skipping backup"
                 ),
-                last_backup_time.strftime("%Y/%m/%d %H:%M:%S"),
+                last_backup_time.isoformat(sep=" ", timespec="seconds"),
                 buff,
             )
             logger.info("Process completed")
             return
+    elif cachedir is not None:
+        # Without a buffer check, only use a cached list here. Otherwise the
+        # list is fetched after the backup so that a failure to list the
+        # archives cannot prevent the backup.
+        backups, backup_times = load_list_cache(base, cachedir) or (None, None)
+        if backups is not None:
+            logger.info("Using cached archive list")
 
-    time.sleep(delay)
+    wait(delay)
 
     # Attempt to run backup until it succeeds or fails too many times (e.g. due
     # to lack of network connection)
     for attempt in range(MAX_RETRY):
-        exit_code = run_single_backup(target, base)
+        created = datetime.datetime.now().replace(microsecond=0)
+        exit_code = run_single_backup(target, base, created)
         if exit_code == 0:
-            remove_backups(base, aging_params)
+            if backups is not None:
+                # Reuse the list fetched before the backup rather than fetching
+                # it again. The new archive is the only one that has changed.
+                backups.insert(0, archive_name(base, created))
+                backup_times.insert(0, created)
+            remove_backups(base, aging_params, backups, backup_times, cachedir)
             break
         if attempt < MAX_RETRY - 1:
-            logger.info("Backup failed. Retrying in %d", RETRY_DELAY)
-            time.sleep(RETRY_DELAY)
+            retry_wait = retry_delay(attempt)
+            logger.info("Backup failed. Retrying in %d", retry_wait)
+            time.sleep(retry_wait)
         else:
             logger.info("Max number of retries exceeded.")
 
@@ -75,6 +75,18 @@ def main(args_list: None | list[str] = None):
         default=None,
         help=("String to use when creating backup name"),
     )
+    parser.add_argument(
+        "--cachedir",
+        type=str,
+        default=None,
+        help=(
+            "tarsnap cache directory. If given, the archive list is cached and "
+            "only fetched from the tarsnap server again when the cache "
+            "directory has been modified by something other than this "
+            "script. Only use this if no other machine creates or deletes "
+            "these archives."
+        ),
+    )
     args = parser.parse_args(args_list)
     # pylint: enable=invalid-name
 
@@ -90,4 +102,5 @@ def main(args_list: None | list[str] = None):
         buff=args.buffer,
         aging_params=args.aging,
         name=args.name,
+        cachedir=args.cachedir,
     )
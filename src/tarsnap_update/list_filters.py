@@ -17,45 +17,101 @@
 #
 # Copyright 2025, Will Shanks
 
+import numbers
+from bisect import bisect_left
+from functools import lru_cache
+
 __all__ = ["space_by_span"]
 
+# Importing numba and loading the compiled select_spaced takes longer than
+# selecting from lists shorter than this in pure Python
+NUMBA_MIN_SIZE = 500_000
 
-def spacing_lookup(distance, spacing_params):
-    """Determine the spacing that applies for distance
 
-    distance is compared to the bounds in spacing_params. The spacing
-    associated with the smallest bound greater than distance is returned.
-    """
-    spacing = None
-    for spacing, bound in spacing_params:
-        if distance < bound:
-            break
-    return spacing
+def bound_indices(target, spacing_params):
+    """Find the index of the spacing_params entry that applies to each element
 
+    target -- sorted list of elements
+    spacing_params -- spacing params list
 
-def eligible_followers(target, index, spacing_params):
-    """Find elements within spacing of element of target
+    Since target is sorted, the distance of each element from the first element
+    never decreases, so the element at which each bound is crossed can be found
+    with a binary search rather than comparing every element to the bounds."""
+    indices = []
+    start = 0
+    for param_idx, (_, bound) in enumerate(spacing_params[:-1]):
+        end = bisect_left(
+            target, bound, lo=start, key=lambda elem: abs(elem - target[0])
+        )
+        indices.extend([param_idx] * (end - start))
+        start = end
+    indices.extend([len(spacing_params) - 1] * (len(target) - start))
+    return indices
 
-    target -- list of elements
-    index -- starting index to compare subsequent elements to
-    spacing_params -- spacing params list
 
-    Elements following index are examined to see if they want the same spacing
-    as index and, if so, if they are within spacing of index."""
-    followers = []
-    cur_spacing = spacing_lookup(abs(target[index] - target[0]), spacing_params)
-    for jdx in range(index + 1, len(target)):
-        j_spacing = spacing_lookup(abs(target[jdx] - target[0]), spacing_params)
+def select_spaced(target, bounds, spacings):
+    """Select the elements of sorted target to keep
 
-        j_distance = abs(target[jdx] - target[index])
+    target -- sorted list of elements
+    bounds -- index of the spacing that applies to each element of target (see
+        bound_indices)
+    spacings -- list of spacings from spacing_params
 
-        # Extra 5% cushion to avoid edge cases
-        if j_spacing == cur_spacing and j_distance < 1.05 * cur_spacing:
-            followers.append(jdx)
-        else:
-            break
+    This is the selection loop of space_by_span. It only uses indexing and
+    arithmetic on its arguments so that it can also be compiled with numba when
+    target is numeric."""
+    # Always keep first element
+    keep = [0]
+    while keep[-1] < len(target) - 1:
+        index = keep[-1]
+        spacing = spacings[bounds[index]]
+
+        # Followers are the elements after index that want the same spacing as
+        # index and are within spacing of it (extra 5% cushion to avoid edge
+        # cases). Choose the one closest to being one spacing away.
+        choice = index + 1
+        best = spacing
+        jdx = index + 1
+        while (
+            jdx < len(target)
+            and spacings[bounds[jdx]] == spacing
+            and abs(target[jdx] - target[index]) < 1.05 * spacing
+        ):
+            distance = abs(spacing - abs(target[index] - target[jdx]))
+            if jdx == index + 1 or distance < best:
+                choice = jdx
+                best = distance
+            jdx += 1
+        keep.append(choice)
+
+    return keep
+
+
+@lru_cache(maxsize=1)
+def numba_select_spaced():
+    """Compile select_spaced with numba
+
+    Returns a function with the same arguments as select_spaced for numeric
+    target and spacings, or None if numba is not installed. numba is only
+    imported here so that short runs do not pay for importing it.
+    """
+    # pylint: disable=import-outside-toplevel
+    try:
+        import numba
+        import numpy as np
+    except ImportError:
+        return None
+
+    compiled = numba.njit(cache=True)(select_spaced)
+
+    def select(target, bounds, spacings):
+        return compiled(
+            np.asarray(target, dtype=np.float64),
+            np.asarray(bounds, dtype=np.int64),
+            np.asarray(spacings, dtype=np.float64),
+        )
 
-    return followers
+    return select
 
 
 def space_by_span(target, spacing_params, reverse=False):
@@ -99,27 +155,24 @@ def space_by_span(target, spacing_params, reverse=False):
     a certain bound when space_by_span is called repeatedly on a list each time
     a new element is added to the beginning of it).
     """
+    if len(target) < 2:
+        return list(range(len(target)))
+
     sorted_target = sorted(enumerate(target), key=lambda x: x[1], reverse=reverse)
     orig_indices = [elem[0] for elem in sorted_target]
     target = [elem[1] for elem in sorted_target]
-
-    # Always keep first element
-    keep = [0]
-    while keep[-1] < len(target) - 1:
-        # Get elements within spacing
-        spacing = spacing_lookup(
-            abs(target[keep[-1]] - target[keep[0]]), spacing_params
-        )
-        followers = eligible_followers(target, keep[-1], spacing_params)
-
-        # Choose element
-        if followers:
-            distance = [
-                (f, abs(spacing - abs(target[keep[-1]] - target[f]))) for f in followers
-            ]
-            distance.sort(key=lambda x: x[1])
-            keep.append(distance[0][0])
-        else:
-            keep.append(keep[-1] + 1)
+    bounds = bound_indices(target, spacing_params)
+    spacings = [spacing for spacing, _ in spacing_params]
+
+    select = None
+    if (
+        len(target) >= NUMBA_MIN_SIZE
+        and isinstance(target[0], numbers.Real)
+        and isinstance(spacings[0], numbers.Real)
+    ):
+        select = numba_select_spaced()
+    if select is None:
+        select = select_spaced
+    keep = select(target, bounds, spacings)
 
     return [orig_indices[idx] for idx in keep]